@@ -1,18 +1,211 @@
+import json
 import os
 import pathlib
+import re
 import select
 import subprocess
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
 
 
 CURR_DIR = pathlib.Path(__file__).parent.resolve()
 GEOSMIE_DIR = CURR_DIR / "GEOSmie"
 RUNOPTICS_PATH = GEOSMIE_DIR / "runoptics.py"
 RUNBANDS_PATH = GEOSMIE_DIR / "runbands.py"
+CYBERSHUTTLE_PATH = CURR_DIR / "cybershuttle.yml"
 
+# Every pool a child may start (numba, OpenBLAS/MKL, OpenMP) reads one of these
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "NUMBA_NUM_THREADS",
+)
+DEFAULT_MEM_PER_PROCESS_MB = 1024
 
-def run_command(command: list):
-    os.chdir(str(GEOSMIE_DIR))
+
+# --- Resource Detection ---
+
+def read_workspace_resources(path: pathlib.Path = CYBERSHUTTLE_PATH) -> Dict[str, int]:
+    """Reads the min_cpu/min_mem entries of the workspace resources block."""
+    resources: Dict[str, int] = {}
+    if not path.is_file():
+        return resources
+    # Only two flat integer keys are needed, so avoid depending on PyYAML
+    with open(path) as f:
+        for line in f:
+            match = re.match(r"\s*(min_cpu|min_mem)\s*:\s*(\d+)", line)
+            if match:
+                resources[match.group(1)] = int(match.group(2))
+    return resources
+
+
+def _read_first_line(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit() -> Optional[float]:
+    """Returns the cgroup CPU quota in cores, or None when unlimited/unknown."""
+    cpu_max = _read_first_line("/sys/fs/cgroup/cpu.max")  # cgroup v2
+    if cpu_max:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max" and period:
+            return int(quota) / int(period)
+        return None
+    quota = _read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")  # cgroup v1
+    period = _read_first_line("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def cgroup_memory_limit_mb() -> Optional[int]:
+    """Returns the cgroup memory limit in MiB, or None when unlimited/unknown."""
+    limit = _read_first_line("/sys/fs/cgroup/memory.max")  # cgroup v2
+    if limit is None:
+        limit = _read_first_line("/sys/fs/cgroup/memory/memory.limit_in_bytes")  # cgroup v1
+    if not limit or limit == "max":
+        return None
+    limit_mb = int(limit) // (1024 * 1024)
+    # cgroup v1 reports "unlimited" as a huge page-aligned number
+    if limit_mb >= 2 ** 40:
+        return None
+    return limit_mb
+
+
+def host_available_memory_mb() -> Optional[int]:
+    """Returns MemAvailable from /proc/meminfo in MiB."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+def detect_resources() -> Dict[str, Any]:
+    """Collects usable cores and memory, noting where each number came from."""
+    spec = read_workspace_resources()
+    notes = []
+
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+        notes.append(f"{cpus} core(s) in this process's CPU affinity mask")
+    else:
+        cpus = os.cpu_count() or spec.get("min_cpu", 1)
+        notes.append(f"{cpus} core(s) reported by the OS")
+    quota = cgroup_cpu_limit()
+    if quota is not None and int(quota) < cpus:
+        cpus = max(1, int(quota))
+        notes.append(f"cgroup CPU quota of {quota:g} core(s) limits this to {cpus}")
+
+    mem_sources = {
+        "cgroup limit": cgroup_memory_limit_mb(),
+        "host MemAvailable": host_available_memory_mb(),
+    }
+    known = {name: mb for name, mb in mem_sources.items() if mb is not None}
+    if known:
+        mem_source = min(known, key=known.get)
+        mem_mb = known[mem_source]
+        notes.append(f"{mem_mb} MiB memory available ({mem_source})")
+    else:
+        mem_mb = spec.get("min_mem", DEFAULT_MEM_PER_PROCESS_MB)
+        notes.append(f"memory could not be detected, assuming {CYBERSHUTTLE_PATH.name} min_mem of {mem_mb} MiB")
+
+    if "min_cpu" in spec and cpus < spec["min_cpu"]:
+        notes.append(f"warning: fewer cores than the workspace min_cpu of {spec['min_cpu']}")
+    if "min_mem" in spec and mem_mb < spec["min_mem"]:
+        notes.append(f"warning: less memory than the workspace min_mem of {spec['min_mem']} MiB")
+
+    return {"cpus": cpus, "mem_mb": mem_mb, "spec": spec, "notes": notes}
+
+
+def plan_workers(
+    num_jobs: int,
+    mem_per_process_mb: int = DEFAULT_MEM_PER_PROCESS_MB,
+    max_processes: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Chooses processes and threads per process so the total never exceeds the cores."""
+    resources = detect_resources()
+    cpus, mem_mb = resources["cpus"], resources["mem_mb"]
+    report = list(resources["notes"])
+
+    processes = max(1, min(num_jobs, cpus))
+    report.append(f"{num_jobs} job(s) over {cpus} core(s) allows {processes} process(es)")
+    mem_bound = max(1, mem_mb // mem_per_process_mb)
+    if mem_bound < processes:
+        processes = mem_bound
+        report.append(f"memory limits this to {processes} process(es) at {mem_per_process_mb} MiB each")
+    if max_processes is not None and max_processes < processes:
+        processes = max(1, max_processes)
+        report.append(f"capped at the requested maximum of {processes} process(es)")
+
+    threads = max(1, cpus // processes)
+    report.append(f"each process gets {threads} thread(s) ({processes} x {threads} <= {cpus} cores)")
+
+    return {
+        "processes": processes,
+        "threads_per_process": threads,
+        "cpus": cpus,
+        "mem_mb": mem_mb,
+        "report": report,
+    }
+
+
+def print_plan_report(plan: Dict[str, Any]):
+    print("--- Worker plan ---")
+    for line in plan["report"]:
+        print(f"\t{line}")
+    print(f"--- {plan['processes']} process(es) x {plan['threads_per_process']} thread(s) ---")
+
+
+def thread_limited_env(threads: int) -> Dict[str, str]:
+    """Returns a copy of the current environment with every thread pool capped."""
+    env = dict(os.environ)
+    for var in THREAD_ENV_VARS:
+        env[var] = str(threads)
+    return env
+
+
+# --- Particle Files ---
+
+def resolve_geosmie_path(path) -> pathlib.Path:
+    """Resolves a path from a particle file; relative paths are relative to GEOSmie."""
+    path = pathlib.Path(os.path.expanduser(str(path)))
+    return path if path.is_absolute() else GEOSMIE_DIR / path
+
+
+def kernel_params(fq_fname) -> Optional[Dict[str, pathlib.Path]]:
+    """Returns the resolved kernel and shape_dist paths of a kernel-mode particle, else None."""
+    with open(fq_fname) as f:
+        particle = json.load(f)
+    if particle.get("mode") != "kernel":
+        return None
+    params = particle.get("kernel_params", {})
+    if "path" not in params:
+        raise ValueError(f"{fq_fname} is in kernel mode but has no kernel_params.path")
+    resolved = {"path": resolve_geosmie_path(params["path"])}
+    if "shape_dist" in params:
+        resolved["shape_dist"] = resolve_geosmie_path(params["shape_dist"])
+    for name, path in resolved.items():
+        if not path.is_file():
+            raise FileNotFoundError(f"kernel_params.{name} not found at {path}")
+    return resolved
+
+
+# --- Script Execution ---
+
+def run_command(command: list, env: Optional[Dict[str, str]] = None):
     last_stdout_line = None
     all_stdout_lines = []
     stderr_output = []
@@ -23,6 +216,8 @@ def run_command(command: list):
             stderr=subprocess.PIPE,
             text=True,
             bufsize=1,
+            cwd=str(GEOSMIE_DIR),
+            env=env,
         )
         streams = [process.stdout, process.stderr]
         while process.poll() is None or streams:
@@ -66,12 +261,10 @@ def run_command(command: list):
         print(f"\n--- Script finished with return code: {return_code} ---")
     except Exception as e:
         print(f"Error occurred: {e}")
-    finally:
-        os.chdir("..")
     return last_stdout_line, all_stdout_lines, stderr_output
 
 
-def runoptics(fname: str):
+def runoptics(fname: str, env: Optional[Dict[str, str]] = None):
     fq_fname = GEOSMIE_DIR / fname
     
     # --- Run runoptics.py ---
@@ -83,13 +276,21 @@ def runoptics(fname: str):
         return
         
     command = ["python", '-u', RUNOPTICS_PATH, "--name", fq_fname]
+    try:
+        kernel = kernel_params(fq_fname)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        return
+    if kernel is not None:
+        # Serves GEOSmie's kernel reads from the node's shared tables
+        command = ["python", "-u", CURR_DIR / "kernel_tables.py", "--exec", kernel["path"]] + command[2:]
     print("Running optics")
-    last_stdout_line, _, _ = run_command(command)
+    last_stdout_line, _, _ = run_command(command, env=env)
     
     return last_stdout_line.strip().split("Done, output file: ")[1]
 
 
-def runbands(fname):
+def runbands(fname, env: Optional[Dict[str, str]] = None):
     fq_fname = GEOSMIE_DIR / fname
     
     # --- Run runbands.py ---
@@ -102,28 +303,169 @@ def runbands(fname):
         
     command = ["python", '-u', RUNBANDS_PATH, "--filename", fq_fname]
     print("Running bands")
-    last_stdout_line, _, _ = run_command(command)
+    last_stdout_line, _, _ = run_command(command, env=env)
+
+
+def start_daemon(
+    processes: Optional[int] = None,
+    max_jobs: Optional[int] = None,
+    max_rss_mb: Optional[float] = None,
+    warmup_particle: Optional[str] = None,
+    timeout: float = 120.0,
+):
+    import mie_daemon
+
+    if mie_daemon.is_running(require_healthy=False):
+        state = "" if mie_daemon.is_running() else " but its workers failed to start, stop it first"
+        print(f"GEOSmie daemon already running on {mie_daemon.SOCKET_PATH}{state}")
+        return
+
+    # By default keep one warm worker per core that memory allows
+    num_workers = processes if processes is not None else detect_resources()["cpus"]
+    plan = plan_workers(num_workers)
+    print_plan_report(plan)
+
+    command = [
+        sys.executable, "-u", str(CURR_DIR / "mie_daemon.py"),
+        "--processes", str(plan["processes"]),
+        "--threads", str(plan["threads_per_process"]),
+    ]
+    if max_jobs is not None:
+        command += ["--max-jobs", str(max_jobs)]
+    if max_rss_mb is not None:
+        command += ["--max-rss-mb", str(max_rss_mb)]
+    if warmup_particle is not None:
+        command += ["--warmup-particle", warmup_particle]
+
+    log_path = CURR_DIR / "mie_daemon.log"
+    with open(log_path, "a") as log:
+        subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=str(CURR_DIR), start_new_session=True)
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if mie_daemon.is_running(require_healthy=False):
+            print(f"GEOSmie daemon started on {mie_daemon.SOCKET_PATH} (log: {log_path})")
+            return
+        time.sleep(0.2)
+    print(f"Error: GEOSmie daemon did not start within {timeout:.0f}s, see {log_path}")
+
+
+def stop_daemon():
+    import mie_daemon
+
+    if mie_daemon.is_running(require_healthy=False):
+        mie_daemon.shutdown()
+        print("GEOSmie daemon stopped")
+    else:
+        print("GEOSmie daemon is not running")
+
 
+def compute_mie(
+    fname: str,
+    env: Optional[Dict[str, str]] = None,
+    parallel_bins: bool = False,
+    max_processes: Optional[int] = None,
+):
+    """Runs optics and bands for one particle; returns the optics file name.
 
-def compute_mie(fname: str):
+    With parallel_bins, each major size bin runs as its own optics job
+    (bin_parallel) and the warm daemon is not used.
+    """
     geosmie_dir_str = str(GEOSMIE_DIR)
     if geosmie_dir_str not in sys.path:
         sys.path.insert(0, geosmie_dir_str)
 
+    if parallel_bins:
+        import bin_parallel
+
+        return bin_parallel.compute_mie_binned(fname, max_processes)
+
+    import mie_daemon
+
+    if mie_daemon.is_running():
+        print("Running optics and bands on warm daemon worker")
+        try:
+            return mie_daemon.submit(fname)["optics"]
+        except Exception as e:
+            print(f"Error occurred: {e}")
+            return
+
+    if env is None:
+        plan = plan_workers(1)
+        print_plan_report(plan)
+        env = thread_limited_env(plan["threads_per_process"])
+
     try:
-        optic_fname = runoptics(fname)
-        runbands(optic_fname)
+        optic_fname = runoptics(fname, env=env)
+        runbands(optic_fname, env=env)
+        return optic_fname
     except Exception as e:
         print(f"Error occurred: {e}")
     finally:
         pass
 
 
+def prepare_kernel_tables(fnames: List[str]) -> Dict[str, str]:
+    """Converts each distinct kernel used by the batch once, before workers start.
+
+    Returns the particles whose kernel could not be prepared, with the reason;
+    their jobs still run and GEOSmie reports the problem itself.
+    """
+    failures: Dict[str, str] = {}
+    kernel_users: Dict[pathlib.Path, List[str]] = {}
+    for fname in fnames:
+        fq_fname = GEOSMIE_DIR / fname
+        if not fq_fname.is_file():
+            continue
+        try:
+            kernel = kernel_params(fq_fname)
+        except (OSError, ValueError) as e:
+            failures[fname] = str(e)
+            continue
+        if kernel is not None:
+            kernel_users.setdefault(kernel["path"], []).append(fname)
+    if kernel_users:
+        import kernel_tables
+
+        for kernel_path, users in sorted(kernel_users.items()):
+            try:
+                table_dir = kernel_tables.convert_kernel(kernel_path)
+                print(f"Kernel tables for {kernel_path} shared from {table_dir}")
+            except Exception as e:
+                failures.update({fname: f"kernel conversion failed: {e}" for fname in users})
+
+    for fname, reason in failures.items():
+        print(f"Error: {fname}: {reason}")
+    return failures
+
+
+def compute_mie_batch(fnames: List[str], max_processes: Optional[int] = None, parallel_bins: bool = False):
+    prepare_kernel_tables(fnames)
+    if parallel_bins:
+        # Each particle already spreads its bins over the planned processes
+        for fname in fnames:
+            compute_mie(fname, parallel_bins=True, max_processes=max_processes)
+        return
+
+    plan = plan_workers(len(fnames), max_processes=max_processes)
+    print_plan_report(plan)
+    env = thread_limited_env(plan["threads_per_process"])
+
+    # Each job is its own child process, so threads here only wait on them
+    with ThreadPoolExecutor(max_workers=plan["processes"]) as executor:
+        list(executor.map(lambda fname: compute_mie(fname, env=env), fnames))
+    return plan
+
+
 if __name__ == "__main__":
     test_fname = "geosparticles/bc.json"
-    if len(sys.argv) < 2:
-        compute_mie(test_fname)
+    parallel_bins = "--bins" in sys.argv
+    fnames = [arg for arg in sys.argv[1:] if arg != "--bins"]
+    if not fnames:
+        compute_mie(test_fname, parallel_bins=parallel_bins)
+    elif len(fnames) == 1:
+        compute_mie(fnames[0], parallel_bins=parallel_bins)
     else:
-        compute_mie(sys.argv[1])
+        compute_mie_batch(fnames, parallel_bins=parallel_bins)
     # test_bands_fname = "optics_bc.nomom.nc4"
     # runbands(test_bands_fname)
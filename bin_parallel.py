@@ -0,0 +1,226 @@
+import copy
+import json
+import math
+import os
+import pathlib
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from backend import GEOSMIE_DIR, plan_workers, print_plan_report, runbands, runoptics, thread_limited_env
+
+
+BIN_PARTICLE_DIR = "geosparticles/_bins"
+# Each run writes its bins under a fresh BIN_PARTICLE_DIR/<stem>__run<token>
+RUN_SUFFIX = "__run"
+BIN_SUFFIX = "__bin"
+# Dimension GEOSmie/GOCART optics tables use for the size bins
+BIN_DIM_CANDIDATES = ("radius", "bin", "nbin")
+# 'du' bins have no numperdec; assume GEOSmie's default grid density for cost estimates
+DEFAULT_NUMPERDEC = 100
+
+
+def num_major_bins(particle: Dict[str, Any]) -> int:
+    return len(particle["psd"]["params"]["fracs"])
+
+
+def split_particle(particle: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+    """Splits a particle definition into independent single-bin definitions.
+
+    Hydrophobic particles are refused: their extra non-growing bin changes
+    RH-dependent variables such as gf, which a per-bin merge cannot
+    represent, and no binned run has been checked against a serial one.
+    """
+    if particle.get("hydrophobic"):
+        raise ValueError("hydrophobic particles cannot be split into independent bins; run them serially")
+    nbins = num_major_bins(particle)
+    parts = []
+    for i in range(nbins):
+        part = copy.deepcopy(particle)
+        if isinstance(particle["rhop0"], list):
+            part["rhop0"] = particle["rhop0"][i]
+        part["psd"]["params"] = {
+            key: [value[i]] if isinstance(value, list) and len(value) == nbins else value
+            for key, value in particle["psd"]["params"].items()
+        }
+        parts.append((str(i), part))
+    return parts
+
+
+def _as_list(value) -> list:
+    return value if isinstance(value, list) else [value]
+
+
+def bin_cost(part: Dict[str, Any]) -> float:
+    """Estimates a single-bin run's cost by the size of its radius grid."""
+    params = part["psd"]["params"]
+    numperdec = params.get("numperdec", [DEFAULT_NUMPERDEC])[0]
+    if "rmin0" in params:
+        rmins, rmaxs = _as_list(params["rmin0"][0]), _as_list(params["rmax0"][0])
+    else:
+        rmins, rmaxs = _as_list(params["rMinMaj"][0]), _as_list(params["rMaxMaj"][0])
+    points = sum(numperdec * math.log10(rmax / rmin) for rmin, rmax in zip(rmins, rmaxs) if rmin > 0 and rmax > rmin)
+    # Mie cost grows with size parameter too, so weight by the largest radius
+    return max(points, 1.0) * max(rmaxs)
+
+
+def write_bin_particles(fname: str, run_dir: pathlib.Path) -> List[Tuple[str, str, float]]:
+    """Writes per-bin particle files into this run's directory under GEOSmie's particles.
+
+    The run directory's name is part of every bin's stem, so concurrent runs
+    of the same particle never share particle or output files.
+    Returns (label, GEOSmie-relative file name, cost) per bin, in output order.
+    """
+    fq_fname = GEOSMIE_DIR / fname
+    with open(fq_fname) as f:
+        particle = json.load(f)
+
+    bins = []
+    for label, part in split_particle(particle):
+        bin_fname = os.path.relpath(run_dir / f"{run_dir.name}{BIN_SUFFIX}{label}.json", GEOSMIE_DIR)
+        with open(GEOSMIE_DIR / bin_fname, "w") as f:
+            json.dump(part, f, indent=2)
+        bins.append((label, bin_fname, bin_cost(part)))
+    return bins
+
+
+def _bin_dim(ds) -> str:
+    for name in BIN_DIM_CANDIDATES:
+        if name in ds.dimensions:
+            return name
+    raise ValueError(f"No bin dimension ({', '.join(BIN_DIM_CANDIDATES)}) in {ds.filepath()}")
+
+
+def same_values(a, b) -> bool:
+    import numpy as np
+
+    a, b = np.ma.filled(a), np.ma.filled(b)
+    return np.array_equal(a, b, equal_nan=np.issubdtype(a.dtype, np.inexact) and np.issubdtype(b.dtype, np.inexact))
+
+
+def _check_shared(sources, bin_dim: str):
+    """Raises if anything without the bin dimension differs between the single-bin files.
+
+    Such variables are written once, so a per-bin value would otherwise be
+    silently taken from the first bin.
+    """
+    first = sources[0]
+    problems = []
+    for src in sources[1:]:
+        for name, dim in first.dimensions.items():
+            if name != bin_dim and (name not in src.dimensions or len(src.dimensions[name]) != len(dim)):
+                problems.append(f"dimension {name} differs in {src.filepath()}")
+        for name in set(src.variables) ^ set(first.variables):
+            problems.append(f"variable {name} is not in every bin file ({src.filepath()})")
+        for name, var in first.variables.items():
+            if bin_dim in var.dimensions or name not in src.variables:
+                continue
+            other = src.variables[name]
+            if other.dimensions != var.dimensions or not same_values(var[...], other[...]):
+                problems.append(f"{name} has no {bin_dim} dimension but differs in {src.filepath()}")
+    if problems:
+        raise ValueError("Cannot merge bin outputs: " + "; ".join(problems))
+
+
+def merge_bin_outputs(bin_fnames: List[str], out_fname: str):
+    """Concatenates single-bin optics files along the bin dimension."""
+    import netCDF4
+    import numpy as np
+
+    sources = [netCDF4.Dataset(str(GEOSMIE_DIR / name)) for name in bin_fnames]
+    try:
+        first = sources[0]
+        bin_dim = _bin_dim(first)
+        _check_shared(sources, bin_dim)
+        with netCDF4.Dataset(str(GEOSMIE_DIR / out_fname), "w", format=first.data_model) as out:
+            out.setncatts({attr: first.getncattr(attr) for attr in first.ncattrs()})
+            for name, dim in first.dimensions.items():
+                if name == bin_dim:
+                    size = sum(len(src.dimensions[bin_dim]) for src in sources)
+                else:
+                    size = None if dim.isunlimited() else len(dim)
+                out.createDimension(name, size)
+
+            for name, var in first.variables.items():
+                fill_value = var.getncattr("_FillValue") if "_FillValue" in var.ncattrs() else None
+                out_var = out.createVariable(name, var.datatype, var.dimensions, zlib=True, fill_value=fill_value)
+                out_var.setncatts({attr: var.getncattr(attr) for attr in var.ncattrs() if attr != "_FillValue"})
+                if bin_dim in var.dimensions:
+                    axis = var.dimensions.index(bin_dim)
+                    out_var[...] = np.ma.concatenate([src.variables[name][...] for src in sources], axis=axis)
+                else:
+                    out_var[...] = var[...]
+    finally:
+        for src in sources:
+            src.close()
+
+
+def runoptics_binned(fname: str, max_processes: Optional[int] = None) -> Optional[str]:
+    """Runs each major bin as its own optics job, then merges."""
+    stem = pathlib.Path(fname).stem
+    parent = GEOSMIE_DIR / BIN_PARTICLE_DIR
+    parent.mkdir(parents=True, exist_ok=True)
+    run_dir = pathlib.Path(tempfile.mkdtemp(prefix=f"{stem}{RUN_SUFFIX}", dir=parent))
+    outputs = {}
+    try:
+        try:
+            bins = write_bin_particles(fname, run_dir)
+        except ValueError as e:
+            print(f"Error: {fname}: {e}")
+            return
+        plan = plan_workers(len(bins), max_processes=max_processes)
+        print_plan_report(plan)
+        env = thread_limited_env(plan["threads_per_process"])
+
+        # Submitting the largest radius grids first keeps one big bin from running last
+        by_cost = sorted(bins, key=lambda b: b[2], reverse=True)
+        for label, bin_fname, cost in by_cost:
+            print(f"\tbin {label}: {bin_fname} (relative cost {cost / by_cost[0][2]:.2f})")
+
+        with ThreadPoolExecutor(max_workers=plan["processes"]) as executor:
+            futures = {label: executor.submit(runoptics, bin_fname, env) for label, bin_fname, _ in by_cost}
+            for label, future in futures.items():
+                try:
+                    outputs[label] = future.result()
+                except Exception as e:
+                    print(f"Error occurred in bin {label}: {e}")
+                    outputs[label] = None
+
+        failed = [label for label, output in outputs.items() if not output]
+        if failed:
+            print(f"Error: optics failed for bin(s) {', '.join(failed)}")
+            return
+
+        bin_outputs = [outputs[label] for label, _, _ in bins]
+        bin_stem = f"{run_dir.name}{BIN_SUFFIX}{bins[0][0]}"
+        if bin_stem not in bin_outputs[0]:
+            print(f"Error: cannot derive the merged file name from {bin_outputs[0]}")
+            return
+        out_fname = bin_outputs[0].replace(bin_stem, stem)
+        merge_bin_outputs(bin_outputs, out_fname)
+        print(f"Done, output file: {out_fname}")
+        return out_fname
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+        for output in outputs.values():
+            if output:
+                (GEOSMIE_DIR / output).unlink(missing_ok=True)
+
+
+def compute_mie_binned(fname: str, max_processes: Optional[int] = None):
+    try:
+        optic_fname = runoptics_binned(fname, max_processes)
+        if optic_fname:
+            runbands(optic_fname, env=thread_limited_env(plan_workers(1)["threads_per_process"]))
+        return optic_fname
+    except Exception as e:
+        print(f"Error occurred: {e}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} particle.json [max_processes]")
+        sys.exit(1)
+    compute_mie_binned(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None)
@@ -0,0 +1,364 @@
+import copy
+import hashlib
+import json
+import math
+import pathlib
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from backend import GEOSMIE_DIR, plan_workers, print_plan_report, runoptics, thread_limited_env
+from bin_parallel import BIN_SUFFIX, merge_bin_outputs, same_values, split_particle
+from optics_diff import compare_files, print_report
+
+
+COMPONENT_DIR = "_components"
+MIXED_DIR = "_mixed"
+# Per kg of dry mass, so they mix with dry-mass weights and scale with 1/rhop0
+EXTENSIVE_VARS = ("bext", "bsca", "bbck", "volume", "area")
+# Averages over the scattered light, so they mix with scattering weights
+SCATTERING_WEIGHTED_VARS = ("g", "pmom", "pback")
+DRY_DENSITY_VARS = ("rhod", "rhop0")
+# Depend only on the wavelength/RH grids and refractive index, never on the
+# size distribution, so every component must agree on them; coordinate
+# variables are treated the same way
+INVARIANT_VARS = ("lambda", "rh", "gf", "refreal", "refimag")
+MIXABLE_PSD_TYPES = ("lognorm", "du")
+VERIFY_RTOL = 1e-3
+# Components whose mixing passed verify_mixing against a direct GEOSmie run
+VERIFIED_FNAME = "verified.json"
+
+
+# --- Sub-distribution Components ---
+
+def split_components(part: Dict[str, Any]) -> List[Tuple[float, Dict[str, Any]]]:
+    """Splits a single-bin particle into (frac, single-sub-distribution particle) pairs."""
+    params = part["psd"]["params"]
+    fracs = params["fracs"][0]
+    if part["psd"]["type"] not in MIXABLE_PSD_TYPES:
+        return [(1.0, part)]
+
+    components = []
+    for j, frac in enumerate(fracs):
+        component = copy.deepcopy(part)
+        component["psd"]["params"] = {
+            key: [[value[0][j]]] if isinstance(value[0], list) else value
+            for key, value in params.items()
+        }
+        component["psd"]["params"]["fracs"] = [[1.0]]
+        components.append((frac, component))
+    return components
+
+
+def component_key(component: Dict[str, Any]) -> str:
+    """Identifies a component by everything except its density and weight."""
+    keyed = copy.deepcopy(component)
+    keyed.pop("rhop0", None)
+    keyed["psd"]["params"].pop("fracs", None)
+    return hashlib.sha1(json.dumps(keyed, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def dry_volume_per_particle(component: Dict[str, Any]) -> float:
+    """Mean dry particle volume of a normalized sub-distribution.
+
+    'lognorm' is a lognormal truncated to [rmin0, rmax0]; 'du' sub-bins
+    are taken to have constant dV/dlnr between rMinMaj and rMaxMaj.
+    """
+    psd_type = component["psd"]["type"]
+    params = component["psd"]["params"]
+    if psd_type == "lognorm":
+        r0, sigma = params["r0"][0][0], params["sigma"][0][0]
+        rmin, rmax = params["rmin0"][0][0], params["rmax0"][0][0]
+        numperdec = params["numperdec"][0]
+        dn_dlnr = lambda r: math.exp(-0.5 * (math.log(r / r0) / math.log(sigma)) ** 2)
+    else:
+        rmin, rmax = params["rMinMaj"][0][0], params["rMaxMaj"][0][0]
+        numperdec = 100
+        dn_dlnr = lambda r: r ** -3
+
+    npoints = max(2, int(math.ceil(numperdec * math.log10(rmax / rmin))) + 1)
+    dlnr = math.log(rmax / rmin) / (npoints - 1)
+    number = volume = 0.0
+    for i in range(npoints):
+        r = rmin * math.exp(i * dlnr)
+        weight = 0.5 if i in (0, npoints - 1) else 1.0
+        number += weight * dn_dlnr(r)
+        volume += weight * dn_dlnr(r) * 4.0 / 3.0 * math.pi * r ** 3
+    return volume / number
+
+
+def _component_paths(key: str):
+    store = GEOSMIE_DIR / COMPONENT_DIR
+    return store / f"{key}.nc4", store / f"{key}.json"
+
+
+def particle_components(particle: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """All sub-distribution components of a particle, by component_key."""
+    return {
+        component_key(component): component
+        for _, part in split_particle(particle)
+        for _, component in split_components(part)
+    }
+
+
+def _load_verified() -> Dict[str, Any]:
+    path = GEOSMIE_DIR / COMPONENT_DIR / VERIFIED_FNAME
+    if not path.is_file():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _record_verified(keys: List[str], fname: str, rtol: float):
+    verified = _load_verified()
+    for key in keys:
+        verified[key] = {"particle": fname, "rtol": rtol, "verified_at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    path = GEOSMIE_DIR / COMPONENT_DIR / VERIFIED_FNAME
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(verified, f, indent=2)
+
+
+def build_components(fname: str, max_processes: Optional[int] = None) -> Optional[int]:
+    """Runs optics for every sub-distribution of a particle that is not yet stored.
+
+    Returns how many components were built, or None if any of them failed.
+    """
+    with open(GEOSMIE_DIR / fname) as f:
+        particle = json.load(f)
+
+    missing = {key: component for key, component in particle_components(particle).items()
+               if not _component_paths(key)[1].is_file()}
+    if not missing:
+        print("All components already stored")
+        return 0
+
+    store = GEOSMIE_DIR / COMPONENT_DIR
+    store.mkdir(parents=True, exist_ok=True)
+    for key, component in missing.items():
+        with open(store / f"{key}.particle.json", "w") as f:
+            json.dump(component, f, indent=2)
+
+    plan = plan_workers(len(missing), max_processes=max_processes)
+    print_plan_report(plan)
+    env = thread_limited_env(plan["threads_per_process"])
+
+    def run(key: str) -> bool:
+        try:
+            output = runoptics(f"{COMPONENT_DIR}/{key}.particle.json", env)
+        except Exception as e:
+            print(f"Error occurred in component {key}: {e}")
+            output = None
+        if not output:
+            print(f"Error: optics failed for component {key}")
+            return False
+        nc_path, meta_path = _component_paths(key)
+        try:
+            shutil.move(str(GEOSMIE_DIR / output), str(nc_path))
+            # Metadata is written last, so a stored component is always complete
+            with open(meta_path, "w") as f:
+                json.dump({
+                    "rhop0": missing[key]["rhop0"],
+                    "dry_volume": dry_volume_per_particle(missing[key]),
+                    "particle": missing[key],
+                }, f, indent=2)
+        except OSError as e:
+            print(f"Error: could not store component {key}: {e}")
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=plan["processes"]) as executor:
+        built = list(executor.map(run, missing))
+    if not all(built):
+        print(f"Error: {built.count(False)} of {len(missing)} component(s) failed")
+        return
+    return len(missing)
+
+
+# --- Mixing ---
+
+def _expand(weight, weight_dims, var_dims):
+    """Reshapes a weight array so it broadcasts against a variable with var_dims."""
+    sizes = dict(zip(weight_dims, weight.shape))
+    weight = weight.transpose([weight_dims.index(d) for d in var_dims if d in weight_dims])
+    return weight.reshape([sizes.get(d, 1) for d in var_dims])
+
+
+def mix_bin(part: Dict[str, Any], out_fname: str):
+    """Writes a single-bin optics file as a weighted combination of stored components.
+
+    Raises ValueError for any variable with no mixing rule, or an invariant
+    one that differs between components, rather than copying component 0.
+    """
+    import netCDF4
+    import numpy as np
+
+    rhop0 = part["rhop0"]
+    entries = []
+    for frac, component in split_components(part):
+        nc_path, meta_path = _component_paths(component_key(component))
+        if not meta_path.is_file():
+            raise FileNotFoundError(f"Component not stored, run build_components first: {nc_path.name}")
+        with open(meta_path) as f:
+            entries.append((frac, json.load(f), nc_path))
+
+    mass = np.array([frac * meta["dry_volume"] for frac, meta, _ in entries])
+    weights = mass / mass.sum()
+
+    sources = [netCDF4.Dataset(str(nc_path)) for _, _, nc_path in entries]
+    try:
+        first = sources[0]
+        if "bsca" not in first.variables:
+            raise ValueError(f"Scattering weights need bsca, which {entries[0][2].name} does not have")
+        density_scale = [meta["rhop0"] / rhop0 for _, meta, _ in entries]
+
+        bsca_dims = first.variables["bsca"].dimensions
+        bsca = [src.variables["bsca"][...] * w * s for src, w, s in zip(sources, weights, density_scale)]
+        bsca_total = sum(bsca)
+
+        mixed = {}
+        for name in EXTENSIVE_VARS:
+            if name in first.variables:
+                mixed[name] = sum(src.variables[name][...] * w * s for src, w, s in zip(sources, weights, density_scale))
+        for name in SCATTERING_WEIGHTED_VARS:
+            if name in first.variables:
+                dims = first.variables[name].dimensions
+                total = sum(src.variables[name][...] * _expand(b, bsca_dims, dims) for src, b in zip(sources, bsca))
+                mixed[name] = total / _expand(bsca_total, bsca_dims, dims)
+        for name in DRY_DENSITY_VARS:
+            if name in first.variables:
+                mixed[name] = np.full(first.variables[name].shape, rhop0)
+        if "rEff" in first.variables:
+            if "volume" not in mixed or "area" not in mixed:
+                raise ValueError("rEff cannot be mixed without volume and area")
+            mixed["rEff"] = 0.75 * mixed["volume"] / mixed["area"]
+        if "rhop" in first.variables:
+            if "gf" not in first.variables:
+                raise ValueError("rhop cannot be mixed without gf")
+            # Only the dry core's density changes; the water shell is unchanged
+            gf = first.variables["gf"]
+            rhop = first.variables["rhop"]
+            shrink = _expand(gf[...] ** 3, gf.dimensions, rhop.dimensions)
+            adjusted = [src.variables["rhop"][...] + (rhop0 - meta["rhop0"]) / shrink for src, (_, meta, _) in zip(sources, entries)]
+            if not all(np.ma.allclose(a, adjusted[0]) for a in adjusted[1:]):
+                raise ValueError("Components disagree on wet density rhop after the dry density change")
+            mixed["rhop"] = adjusted[0]
+
+        invariant = set(INVARIANT_VARS) | set(first.dimensions)
+        unhandled = [name for name in first.variables if name not in mixed and name not in invariant]
+        if unhandled:
+            raise ValueError(f"No mixing rule for variable(s) {', '.join(unhandled)} in {entries[0][2].name}")
+        for name in first.variables:
+            if name in mixed:
+                continue
+            for src, (_, _, other_path) in zip(sources[1:], entries[1:]):
+                other = src.variables.get(name)
+                if other is None or other.dimensions != first.variables[name].dimensions \
+                        or not same_values(first.variables[name][...], other[...]):
+                    raise ValueError(f"{name} should not depend on the size distribution but differs in {other_path.name}")
+
+        with netCDF4.Dataset(str(out_fname), "w", format=first.data_model) as out:
+            out.setncatts({attr: first.getncattr(attr) for attr in first.ncattrs()})
+            for name, dim in first.dimensions.items():
+                out.createDimension(name, None if dim.isunlimited() else len(dim))
+            for name, var in first.variables.items():
+                fill_value = var.getncattr("_FillValue") if "_FillValue" in var.ncattrs() else None
+                out_var = out.createVariable(name, var.datatype, var.dimensions, zlib=True, fill_value=fill_value)
+                out_var.setncatts({attr: var.getncattr(attr) for attr in var.ncattrs() if attr != "_FillValue"})
+                out_var[...] = mixed[name] if name in mixed else var[...]
+    finally:
+        for src in sources:
+            src.close()
+
+
+def mix_particle(
+    fname: str,
+    build_missing: bool = True,
+    max_processes: Optional[int] = None,
+    require_verified: bool = True,
+) -> Optional[str]:
+    """Produces a particle's optics file from stored sub-distribution components.
+
+    The mixing weights come from dry_volume_per_particle's own quadrature,
+    not GEOSmie's radius grid, so unless require_verified is off, every
+    component must first have passed verify_mixing in some particle.
+    """
+    fq_fname = GEOSMIE_DIR / fname
+    with open(fq_fname) as f:
+        particle = json.load(f)
+    if particle["psd"]["type"] not in MIXABLE_PSD_TYPES:
+        print(f"Error: psd type '{particle['psd']['type']}' has no sub-distributions to mix")
+        return
+    if particle.get("hydrophobic"):
+        print(f"Error: {fname}: hydrophobic particles cannot be mixed bin by bin; run them serially")
+        return
+    if require_verified:
+        verified = _load_verified()
+        unverified = [key for key in particle_components(particle) if key not in verified]
+        if unverified:
+            print(f"Error: {fname}: component(s) {', '.join(unverified)} have not been verified against a direct run; "
+                  f"run {pathlib.Path(__file__).name} --verify on a particle using them first")
+            return
+    if build_missing and build_components(fname, max_processes) is None:
+        print(f"Error: cannot mix {fname} without all of its components")
+        return
+
+    start = time.perf_counter()
+    mixed_dir = GEOSMIE_DIR / MIXED_DIR
+    mixed_dir.mkdir(parents=True, exist_ok=True)
+    bin_fnames = []
+    out_fname = f"{MIXED_DIR}/optics_{fq_fname.stem}.mixed.nc4"
+    try:
+        for label, part in split_particle(particle):
+            bin_fname = f"{MIXED_DIR}/optics_{fq_fname.stem}{BIN_SUFFIX}{label}.nc4"
+            mix_bin(part, GEOSMIE_DIR / bin_fname)
+            bin_fnames.append(bin_fname)
+        merge_bin_outputs(bin_fnames, out_fname)
+    except (OSError, ValueError) as e:
+        print(f"Error: mixing {fname} failed: {e}")
+        return
+    finally:
+        for bin_fname in bin_fnames:
+            (GEOSMIE_DIR / bin_fname).unlink(missing_ok=True)
+    print(f"Mixed {len(bin_fnames)} bin(s) in {time.perf_counter() - start:.3f}s")
+    print(f"Done, output file: {out_fname}")
+    return out_fname
+
+
+def verify_mixing(fname: str, rtol: float = VERIFY_RTOL, max_processes: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """Diffs a mixed optics file against a direct GEOSmie run of the same particle.
+
+    On a pass, the particle's components are recorded as verified, so
+    mix_particle accepts them in any fracs or rhop0 variant.
+    """
+    mixed = mix_particle(fname, max_processes=max_processes, require_verified=False)
+    if not mixed:
+        return
+    env = thread_limited_env(plan_workers(1, max_processes=max_processes)["threads_per_process"])
+    reference = runoptics(fname, env)
+    if not reference:
+        print(f"Error: reference optics run failed for {fname}")
+        return
+    report = compare_files(GEOSMIE_DIR / reference, GEOSMIE_DIR / mixed, rtol=rtol)
+    print_report(report)
+    if report["passed"]:
+        with open(GEOSMIE_DIR / fname) as f:
+            keys = list(particle_components(json.load(f)))
+        _record_verified(keys, fname, rtol)
+        print(f"Recorded {len(keys)} component(s) as verified")
+    return report
+
+
+if __name__ == "__main__":
+    verify = "--verify" in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != "--verify"]
+    if not args:
+        print(f"Usage: {sys.argv[0]} particle.json [max_processes] [--verify]")
+        sys.exit(1)
+    max_processes = int(args[1]) if len(args) > 1 else None
+    if verify:
+        report = verify_mixing(args[0], max_processes=max_processes)
+        sys.exit(report["exit_code"] if report else 1)
+    sys.exit(0 if mix_particle(args[0], max_processes=max_processes) else 1)
@@ -0,0 +1,424 @@
+import fcntl
+import hashlib
+import json
+import os
+import pathlib
+import runpy
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Dict, IO
+
+import netCDF4
+import numpy as np
+
+from backend import resolve_geosmie_path
+
+
+# /dev/shm is node-local tmpfs, so every worker maps the same physical pages
+SHM_CACHE_DIR = pathlib.Path("/dev/shm/geosmie-kernels")
+DISK_CACHE_DIR = pathlib.Path(__file__).parent.resolve() / ".kernel_cache"
+DEFAULT_CACHE_DIR = pathlib.Path(
+    os.environ.get("GEOSMIE_KERNEL_CACHE", SHM_CACHE_DIR if SHM_CACHE_DIR.parent.is_dir() else DISK_CACHE_DIR)
+)
+# Converted kernels beyond this total are evicted, least recently used first
+CACHE_MAX_MB = int(os.environ.get("GEOSMIE_KERNEL_CACHE_MB", 8192))
+# Headroom left free on the cache filesystem (tmpfs space is RAM)
+CACHE_FREE_MARGIN_MB = 512
+INDEX_FNAME = "index.json"
+# Stored arrays are already unpacked, so these must not be applied twice
+PACKING_ATTRS = ("scale_factor", "add_offset")
+
+_open_tables: Dict[str, "KernelTables"] = {}
+_original_dataset = netCDF4.Dataset
+_shared_paths: Dict[str, pathlib.Path] = {}
+# Shared flocks on the index of every table this process has registered;
+# prune_cache never evicts a table someone still holds
+_held_locks: Dict[pathlib.Path, IO] = {}
+hook_stats = {"served": 0}
+
+
+def _cache_key(nc_path: pathlib.Path) -> str:
+    stat = nc_path.stat()
+    digest = hashlib.sha1(f"{nc_path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:12]
+    return f"{nc_path.stem}-{digest}"
+
+
+def _attrs(obj) -> Dict[str, Any]:
+    """netCDF attributes as JSON-safe values."""
+    attrs = {}
+    for name in obj.ncattrs():
+        value = obj.getncattr(name)
+        attrs[name] = value.tolist() if isinstance(value, (np.ndarray, np.generic)) else value
+    return attrs
+
+
+def _dir_size_mb(path: pathlib.Path) -> float:
+    return sum(f.stat().st_size for f in path.iterdir() if f.is_file()) / (1024 * 1024)
+
+
+def _pick_cache_dir(cache_dir: pathlib.Path, needed_mb: float) -> pathlib.Path:
+    """Falls back to the on-disk cache when the preferred filesystem lacks room."""
+    probe = cache_dir if cache_dir.exists() else cache_dir.parent
+    free_mb = shutil.disk_usage(probe).free / (1024 * 1024)
+    if free_mb - needed_mb >= CACHE_FREE_MARGIN_MB or cache_dir == DISK_CACHE_DIR:
+        return cache_dir
+    print(f"Only {free_mb:.0f} MiB free in {probe}, converting kernel into {DISK_CACHE_DIR} instead", file=sys.stderr)
+    return DISK_CACHE_DIR
+
+
+def convert_kernel(nc_path, cache_dir: pathlib.Path = DEFAULT_CACHE_DIR) -> pathlib.Path:
+    """Converts a kernel netCDF file into one .npy per variable plus an index.
+
+    The conversion runs once per node: the result is published with an atomic
+    rename, so concurrent callers either find it or race to an identical copy.
+    """
+    nc_path = resolve_geosmie_path(nc_path)
+    key = _cache_key(nc_path)
+    for candidate in (cache_dir, DISK_CACHE_DIR):
+        if (candidate / key / INDEX_FNAME).is_file():
+            return candidate / key
+
+    with _original_dataset(str(nc_path)) as ds:
+        needed_mb = sum(var.size * var.dtype.itemsize for var in ds.variables.values() if var.dtype != str) / (1024 * 1024)
+    cache_dir = _pick_cache_dir(cache_dir, needed_mb)
+    prune_cache(cache_dir, CACHE_MAX_MB - needed_mb)
+    table_dir = cache_dir / key
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix=".converting-", dir=cache_dir))
+    try:
+        index: Dict[str, Any] = {"source": str(nc_path.resolve()), "variables": {}, "dimensions": {}}
+        with _original_dataset(str(nc_path)) as ds:
+            ds.set_auto_mask(False)
+            index["attrs"] = _attrs(ds)
+            index["data_model"] = ds.data_model
+            index["dimensions"] = {name: len(dim) for name, dim in ds.dimensions.items()}
+            for name, var in ds.variables.items():
+                data = np.ascontiguousarray(var[...])
+                if data.dtype == object:
+                    # Variable-length strings; fixed-width unicode needs no pickling
+                    data = np.array(data.tolist(), dtype=str)
+                np.save(tmp_dir / f"{name}.npy", data, allow_pickle=False)
+                attrs = {k: v for k, v in _attrs(var).items() if k not in PACKING_ATTRS}
+                fill_value = attrs.get("_FillValue")
+                index["variables"][name] = {
+                    "dims": list(var.dimensions),
+                    "shape": list(data.shape),
+                    "dtype": data.dtype.str,
+                    "attrs": attrs,
+                    # Only variables that actually contain fill values are served masked
+                    "masked": bool(fill_value is not None and np.any(data == fill_value)),
+                }
+
+        with open(tmp_dir / INDEX_FNAME, "w") as f:
+            json.dump(index, f, indent=2)
+        # Tables are shared read-only between workers
+        for path in tmp_dir.iterdir():
+            path.chmod(0o444)
+
+        try:
+            tmp_dir.rename(table_dir)
+        except OSError:
+            # Another process published the same tables first
+            if not (table_dir / INDEX_FNAME).is_file():
+                raise
+    finally:
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return table_dir
+
+
+def _evict(table_dir: pathlib.Path, reason: str) -> bool:
+    """Removes a table unless a process still holds it; returns whether it went."""
+    try:
+        lock = open(table_dir / INDEX_FNAME, "rb")
+    except FileNotFoundError:
+        return False
+    with lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        # Renamed while locked, so share_kernel can never lock a half-deleted table
+        doomed = table_dir.with_name(f".evicting-{table_dir.name}-{os.getpid()}")
+        table_dir.rename(doomed)
+    print(f"{reason} {table_dir}", file=sys.stderr)
+    shutil.rmtree(doomed, ignore_errors=True)
+    return True
+
+
+def prune_cache(cache_dir: pathlib.Path = DEFAULT_CACHE_DIR, max_mb: float = CACHE_MAX_MB):
+    """Removes tables whose source changed or vanished, then the least recently used.
+
+    Tables registered by a live process (share_kernel) are skipped.
+    """
+    if not cache_dir.is_dir():
+        return
+    entries = []
+    for table_dir in cache_dir.iterdir():
+        index_path = table_dir / INDEX_FNAME
+        if not index_path.is_file():
+            continue
+        with open(index_path) as f:
+            source = pathlib.Path(json.load(f)["source"])
+        if not source.is_file() or _cache_key(source) != table_dir.name:
+            if _evict(table_dir, "Removing stale kernel tables"):
+                continue
+        entries.append((index_path.stat().st_mtime, _dir_size_mb(table_dir), table_dir))
+
+    total_mb = sum(size for _, size, _ in entries)
+    for _, size, table_dir in sorted(entries):
+        if total_mb <= max_mb:
+            break
+        if _evict(table_dir, f"Evicting kernel tables ({size:.0f} MiB)"):
+            total_mb -= size
+
+
+def clear_cache(cache_dir: pathlib.Path = DEFAULT_CACHE_DIR):
+    for candidate in {cache_dir, DISK_CACHE_DIR}:
+        if candidate.is_dir():
+            shutil.rmtree(candidate, ignore_errors=True)
+
+
+class KernelTables:
+    """Memory-mapped view of a converted kernel file.
+
+    Every lookup maps the table copy-on-write: pages are shared with other
+    workers until written, and writes stay private to the returned array,
+    as with an array read from netCDF.
+    """
+
+    def __init__(self, table_dir: pathlib.Path):
+        self.table_dir = pathlib.Path(table_dir)
+        with open(self.table_dir / INDEX_FNAME) as f:
+            self.index = json.load(f)
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if name not in self.index["variables"]:
+            raise KeyError(f"Variable {name} not in kernel tables {self.table_dir}")
+        return np.load(self.table_dir / f"{name}.npy", mmap_mode="c")
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index["variables"]
+
+    @property
+    def variables(self):
+        return list(self.index["variables"])
+
+    def dims(self, name: str):
+        return tuple(self.index["variables"][name]["dims"])
+
+
+# --- netCDF4.Dataset stand-in ---
+
+class _Dimension:
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def isunlimited(self) -> bool:
+        return False
+
+
+class KernelVariable:
+    """netCDF4.Variable look-alike; slicing returns writable copy-on-write views."""
+
+    def __init__(self, tables: KernelTables, name: str):
+        self._tables = tables
+        self._info = tables.index["variables"][name]
+        self.name = name
+        self.dimensions = tuple(self._info["dims"])
+        self.shape = tuple(self._info["shape"])
+        self.dtype = np.dtype(self._info["dtype"])
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+
+    def __getitem__(self, key):
+        data = self._tables[self.name][key]
+        if self._info["masked"]:
+            return np.ma.masked_equal(data, self._info["attrs"]["_FillValue"], copy=False)
+        return data
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[...], dtype=dtype)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getattr__(self, name: str):
+        if name.startswith("_") or name not in self._info["attrs"]:
+            raise AttributeError(name)
+        return self._info["attrs"][name]
+
+    def ncattrs(self):
+        return list(self._info["attrs"])
+
+    def getncattr(self, name: str):
+        return self._info["attrs"][name]
+
+    def set_auto_mask(self, value: bool):
+        pass
+
+    set_auto_scale = set_auto_maskandscale = set_auto_mask
+
+
+class KernelDataset:
+    """netCDF4.Dataset look-alike (read mode only) served from shared kernel tables."""
+
+    def __init__(self, tables: KernelTables, nc_path: pathlib.Path):
+        self._tables = tables
+        self._path = str(nc_path)
+        self.data_model = tables.index.get("data_model", "NETCDF4")
+        self.dimensions = {name: _Dimension(name, size) for name, size in tables.index["dimensions"].items()}
+        self.variables = {name: KernelVariable(tables, name) for name in tables.variables}
+        self.groups: Dict[str, Any] = {}
+
+    def __getitem__(self, name: str) -> KernelVariable:
+        return self.variables[name]
+
+    def __getattr__(self, name: str):
+        attrs = self._tables.index.get("attrs", {}) if not name.startswith("_") else {}
+        if name not in attrs:
+            raise AttributeError(name)
+        return attrs[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def ncattrs(self):
+        return list(self._tables.index.get("attrs", {}))
+
+    def getncattr(self, name: str):
+        return self._tables.index["attrs"][name]
+
+    def filepath(self) -> str:
+        return self._path
+
+    def close(self):
+        pass
+
+    def set_auto_mask(self, value: bool):
+        pass
+
+    set_auto_scale = set_auto_maskandscale = set_auto_mask
+
+
+def _shared_dataset(filename, mode="r", *args, **kwargs):
+    """netCDF4.Dataset replacement that serves shared kernels and defers everything else."""
+    if mode == "r" and isinstance(filename, (str, os.PathLike)):
+        table_dir = _shared_paths.get(os.path.realpath(filename))
+        if table_dir is not None:
+            hook_stats["served"] += 1
+            return KernelDataset(open_tables(table_dir), pathlib.Path(filename))
+    return _original_dataset(filename, mode, *args, **kwargs)
+
+
+def install_dataset_hook():
+    """Routes reads of shared kernels through KernelTables for this process.
+
+    Must run before GEOSmie's modules are imported, so that any
+    `from netCDF4 import Dataset` binds the replacement.
+    """
+    netCDF4.Dataset = _shared_dataset
+
+
+def _hold(table_dir: pathlib.Path) -> bool:
+    """Takes a shared lock on a table for the life of this process; False if it was evicted meanwhile."""
+    if table_dir in _held_locks:
+        return True
+    try:
+        lock = open(table_dir / INDEX_FNAME, "rb")
+    except FileNotFoundError:
+        return False
+    fcntl.flock(lock, fcntl.LOCK_SH)
+    if not (table_dir / INDEX_FNAME).is_file():
+        lock.close()
+        return False
+    _held_locks[table_dir] = lock
+    return True
+
+
+def share_kernel(nc_path, cache_dir: pathlib.Path = DEFAULT_CACHE_DIR) -> pathlib.Path:
+    """Converts nc_path if needed and serves later reads of it from the shared tables.
+
+    The tables stay locked against eviction until this process exits or the
+    kernel is shared again from a newer conversion.
+    """
+    nc_path = resolve_geosmie_path(nc_path)
+    for _ in range(3):
+        table_dir = convert_kernel(nc_path, cache_dir)
+        if _hold(table_dir):
+            break
+    else:
+        raise RuntimeError(f"Kernel tables for {nc_path} kept being evicted")
+    previous = _shared_paths.get(os.path.realpath(nc_path))
+    if previous is not None and previous != table_dir and previous in _held_locks:
+        _held_locks.pop(previous).close()
+        _open_tables.pop(str(previous), None)
+    _shared_paths[os.path.realpath(nc_path)] = table_dir
+    # The mtime marks recent use for prune_cache's LRU order
+    os.utime(table_dir / INDEX_FNAME, (time.time(), time.time()))
+    return table_dir
+
+
+def open_tables(table_dir: pathlib.Path) -> KernelTables:
+    """Maps converted tables, reusing the mapping within this process."""
+    key = str(table_dir)
+    if key not in _open_tables:
+        _open_tables[key] = KernelTables(table_dir)
+    return _open_tables[key]
+
+
+def open_kernel(nc_path, cache_dir: pathlib.Path = DEFAULT_CACHE_DIR) -> KernelTables:
+    """Maps the kernel tables for nc_path, converting on first use."""
+    return open_tables(convert_kernel(nc_path, cache_dir))
+
+
+def exec_with_shared_kernel(kernel_path, script, args: list) -> int:
+    """Runs a GEOSmie script in this process with kernel reads served from shared tables."""
+    try:
+        install_dataset_hook()
+        share_kernel(kernel_path)
+    except Exception as e:
+        # Fall back to GEOSmie reading the netCDF file itself
+        netCDF4.Dataset = _original_dataset
+        print(f"Kernel tables unavailable for {kernel_path}, reading netCDF directly: {e}", file=sys.stderr)
+
+    script = str(script)
+    sys.argv = [script] + list(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    exit_code = 0
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    if netCDF4.Dataset is _shared_dataset and not hook_stats["served"]:
+        print(f"Kernel tables unused: {os.path.basename(script)} did not open {kernel_path} through netCDF4.Dataset",
+              file=sys.stderr)
+    return exit_code
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3 and sys.argv[1] == "--exec":
+        # kernel_tables.py --exec KERNEL SCRIPT [ARGS...]
+        sys.exit(exec_with_shared_kernel(sys.argv[2], sys.argv[3], sys.argv[4:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "--clear":
+        clear_cache()
+        sys.exit(0)
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} kernel.nc [cache_dir] | --clear | --exec kernel.nc script.py [args...]")
+        sys.exit(1)
+    cache_dir = pathlib.Path(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_CACHE_DIR
+    tables = open_kernel(sys.argv[1], cache_dir)
+    print(f"Kernel tables at {tables.table_dir}")
+    for name in tables.variables:
+        print(f"\t{name}{tables.dims(name)}: {tables.index['variables'][name]['shape']}")
@@ -0,0 +1,581 @@
+import argparse
+import collections
+import contextlib
+import functools
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import runpy
+import socket
+import socketserver
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from backend import GEOSMIE_DIR, RUNBANDS_PATH, RUNOPTICS_PATH, kernel_params, thread_limited_env
+
+
+SOCKET_PATH = os.environ.get("GEOSMIE_SOCKET", f"/tmp/geosmie-{os.getuid()}.sock")
+DEFAULT_MAX_JOBS_PER_WORKER = 50
+DEFAULT_MAX_RSS_MB = 2048
+# Imported once per worker so jobs only pay for the computation itself
+WARM_MODULES = ("numpy", "scipy", "scipy.integrate", "scipy.interpolate", "netCDF4", "numba")
+# Parsed text tables (RI files, shape distributions) kept per worker
+TEXT_CACHE_SIZE = 64
+# Workers that die before becoming ready are respawned with exponential
+# backoff; after this many in a row the pool stops spawning and fails jobs.
+MAX_STARTUP_FAILURES = 5
+STARTUP_BACKOFF_S = 1.0
+MAX_STARTUP_BACKOFF_S = 30.0
+# How often the dispatcher checks for dead workers, however busy the event queue is
+REAP_INTERVAL_S = 1.0
+
+
+# --- Worker Side ---
+
+class _LineStream(io.TextIOBase):
+    """File-like object forwarding each complete line to a callback."""
+
+    def __init__(self, emit: Callable[[str], None]):
+        self._emit = emit
+        self._buffer = ""
+
+    def write(self, text: str) -> int:
+        self._buffer += text
+        *lines, self._buffer = self._buffer.split("\n")
+        for line in lines:
+            self._emit(line)
+        return len(text)
+
+    def flush(self):
+        if self._buffer:
+            self._emit(self._buffer)
+            self._buffer = ""
+
+
+def _current_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in KiB on Linux and is a peak, which is a safe overestimate
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_script(path, args: list, emit: Callable[[str], None]) -> Optional[str]:
+    """Runs a GEOSmie script in this interpreter, returning its last stdout line."""
+    last_line = None
+
+    def capture(line: str):
+        nonlocal last_line
+        if line.strip():
+            last_line = line.strip()
+        emit(line)
+
+    stream = _LineStream(capture)
+    original_argv = list(sys.argv)
+    sys.argv = [str(path)] + args
+    try:
+        with contextlib.redirect_stdout(stream):
+            try:
+                runpy.run_path(str(path), run_name="__main__")
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    raise RuntimeError(f"{path.name} exited with status {e.code}")
+            finally:
+                stream.flush()
+    finally:
+        sys.argv = original_argv
+    return last_line
+
+
+_text_cache: "collections.OrderedDict[tuple, Any]" = collections.OrderedDict()
+text_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _cached_reader(original: Callable, reader_name: str) -> Callable:
+    @functools.wraps(original)
+    def cached(fname, *args, **kwargs):
+        if not isinstance(fname, (str, os.PathLike)) or not os.path.isfile(fname):
+            return original(fname, *args, **kwargs)
+        stat = os.stat(fname)
+        key = (reader_name, os.path.realpath(fname), stat.st_mtime_ns, stat.st_size, repr(args), repr(sorted(kwargs.items())))
+        if key in _text_cache:
+            text_cache_stats["hits"] += 1
+            _text_cache.move_to_end(key)
+        else:
+            text_cache_stats["misses"] += 1
+            _text_cache[key] = original(fname, *args, **kwargs)
+            if len(_text_cache) > TEXT_CACHE_SIZE:
+                _text_cache.popitem(last=False)
+        # Callers may modify what they get back, so never hand out the cached array
+        return _text_cache[key].copy()
+    return cached
+
+
+def _install_text_cache():
+    """Memoizes numpy's text readers per file, so RI tables are parsed once per worker.
+
+    Must run before GEOSmie's modules are imported, so that any
+    `from numpy import loadtxt` binds the cached reader.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        return
+    for reader_name in ("loadtxt", "genfromtxt"):
+        setattr(np, reader_name, _cached_reader(getattr(np, reader_name), reader_name))
+
+
+def _install_kernel_hook():
+    """Routes GEOSmie's kernel netCDF reads through shared tables, if netCDF4 is available."""
+    try:
+        import kernel_tables
+    except ImportError as e:
+        print(f"Kernel table sharing disabled: {e}", file=sys.stderr)
+        return None
+    kernel_tables.install_dataset_hook()
+    return kernel_tables
+
+
+def _warm_up(warmup_particle: Optional[str]):
+    """Imports the heavy modules once; returns kernel_tables when its hook is installed."""
+    for module in WARM_MODULES:
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+    # Both hooks must be in place before GEOSmie's modules bind numpy/netCDF4 names
+    _install_text_cache()
+    kernel_tables = _install_kernel_hook()
+    # Executing runoptics as a plain module pulls in all of GEOSmie's imports
+    # without running a computation; later __main__ runs reuse sys.modules.
+    for path in (RUNOPTICS_PATH, RUNBANDS_PATH):
+        if path.is_file():
+            # A script that parses argv or exits at import time must not kill the worker
+            try:
+                runpy.run_path(str(path), run_name="geosmie_warmup")
+            except BaseException as e:
+                print(f"Warm-up import of {path.name} failed: {type(e).__name__}: {e}", file=sys.stderr)
+    if warmup_particle:
+        # A full run also compiles the numba kernels for this worker
+        _run_script(RUNOPTICS_PATH, ["--name", str(GEOSMIE_DIR / warmup_particle)], lambda line: None)
+    return kernel_tables
+
+
+def worker_main(
+    worker_id: int,
+    jobs: multiprocessing.Queue,
+    events: multiprocessing.Queue,
+    threads: int,
+    max_jobs: int,
+    max_rss_mb: float,
+    warmup_particle: Optional[str],
+):
+    try:
+        # Thread limits must be in place before numpy/numba are first imported
+        os.environ.update(thread_limited_env(threads))
+        os.chdir(str(GEOSMIE_DIR))
+        if str(GEOSMIE_DIR) not in sys.path:
+            sys.path.insert(0, str(GEOSMIE_DIR))
+        kernel_tables = _warm_up(warmup_particle)
+    except BaseException as e:
+        events.put(("failed", worker_id, None, f"{type(e).__name__}: {e}"))
+        return
+
+    events.put(("ready", worker_id, None, None))
+
+    jobs_done = 0
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, fname = job
+
+        def emit(line: str):
+            events.put(("progress", worker_id, job_id, line))
+
+        hits_before = text_cache_stats["hits"]
+
+        try:
+            fq_fname = GEOSMIE_DIR / fname
+            if not fq_fname.is_file():
+                raise FileNotFoundError(f"Particle file not found at {fq_fname}")
+            kernel = kernel_params(fq_fname)
+            served_before = kernel_tables.hook_stats["served"] if kernel_tables else 0
+            if kernel and kernel_tables:
+                # Converted once per node, then mapped zero-copy by every worker
+                table_dir = kernel_tables.share_kernel(kernel["path"])
+                emit(f"Kernel reads served from {table_dir}")
+            last_line = _run_script(RUNOPTICS_PATH, ["--name", str(fq_fname)], emit)
+            if kernel and kernel_tables and kernel_tables.hook_stats["served"] == served_before:
+                emit(f"Warning: GEOSmie did not open {kernel['path']} through netCDF4.Dataset; shared tables unused")
+            optic_fname = last_line.split("Done, output file: ")[1]
+            _run_script(RUNBANDS_PATH, ["--filename", str(GEOSMIE_DIR / optic_fname)], emit)
+            emit(f"Parsed-table cache: {text_cache_stats['hits'] - hits_before} hit(s) this job, "
+                 f"{len(_text_cache)} table(s) held")
+            events.put(("done", worker_id, job_id, {"optics": optic_fname}))
+        except Exception as e:
+            events.put(("error", worker_id, job_id, f"{type(e).__name__}: {e}"))
+
+        jobs_done += 1
+        rss_mb = _current_rss_mb()
+        if jobs_done >= max_jobs or rss_mb >= max_rss_mb:
+            events.put(("retire", worker_id, None, {"jobs": jobs_done, "rss_mb": round(rss_mb)}))
+            break
+        # Only an idle worker is handed a job, so a retiring one never holds one
+        events.put(("idle", worker_id, None, None))
+
+
+# --- Server Side ---
+
+class WorkerPool:
+    """Pre-warmed worker processes, recycled on demand.
+
+    Each worker has its own job queue and is handed one job at a time, so
+    the pool always knows which job a dead worker was holding.
+    """
+
+    def __init__(
+        self,
+        processes: int,
+        threads: int,
+        max_jobs: int = DEFAULT_MAX_JOBS_PER_WORKER,
+        max_rss_mb: float = DEFAULT_MAX_RSS_MB,
+        warmup_particle: Optional[str] = None,
+    ):
+        self._ctx = multiprocessing.get_context("spawn")
+        self._events = self._ctx.Queue()
+        self._worker_args = (threads, max_jobs, max_rss_mb, warmup_particle)
+        self._workers: Dict[int, Any] = {}
+        self._worker_jobs: Dict[int, multiprocessing.Queue] = {}
+        self._starting = set()
+        self._idle: collections.deque = collections.deque()
+        self._pending: collections.deque = collections.deque()
+        self._running_job: Dict[int, int] = {}
+        self._listeners: Dict[int, queue.Queue] = {}
+        # Guards everything shared between handler threads, the dispatcher and respawn timers
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count()
+        self._worker_ids = itertools.count()
+        self._closed = False
+        self._startup_failures = 0
+        self.broken: Optional[str] = None
+        self.stats = {"jobs": 0, "recycled": 0, "ready": 0, "startup_failures": 0}
+
+        for _ in range(processes):
+            self._spawn_worker()
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def _spawn_worker(self):
+        with self._lock:
+            if self._closed or self.broken:
+                return
+            worker_id = next(self._worker_ids)
+            jobs = self._ctx.Queue()
+            process = self._ctx.Process(
+                target=worker_main,
+                args=(worker_id, jobs, self._events) + self._worker_args,
+                daemon=True,
+            )
+            process.start()
+            self._workers[worker_id] = process
+            self._worker_jobs[worker_id] = jobs
+            self._starting.add(worker_id)
+
+    def _assign_jobs(self):
+        """Hands pending jobs to idle workers, recording each before it is sent."""
+        with self._lock:
+            while self._pending and self._idle:
+                worker_id = self._idle.popleft()
+                if worker_id not in self._workers:
+                    continue
+                job_id, fname = self._pending.popleft()
+                self._running_job[worker_id] = job_id
+                self._worker_jobs[worker_id].put((job_id, fname))
+
+    def _forget_worker(self, worker_id: int):
+        """Drops a worker's bookkeeping; the caller holds _lock."""
+        process = self._workers.pop(worker_id, None)
+        self._worker_jobs.pop(worker_id, None)
+        if worker_id in self._idle:
+            self._idle.remove(worker_id)
+        return process
+
+    def _notify(self, job_id: Optional[int], event: Dict[str, Any]):
+        with self._lock:
+            listener = self._listeners.get(job_id)
+        if listener is not None:
+            listener.put(event)
+
+    def _dispatch(self):
+        next_reap = time.monotonic() + REAP_INTERVAL_S
+        while not self._closed:
+            if time.monotonic() >= next_reap:
+                self._reap_dead_workers()
+                next_reap = time.monotonic() + REAP_INTERVAL_S
+            try:
+                kind, worker_id, job_id, payload = self._events.get(timeout=REAP_INTERVAL_S)
+            except queue.Empty:
+                continue
+
+            if kind in ("ready", "idle"):
+                with self._lock:
+                    if kind == "ready":
+                        self._starting.discard(worker_id)
+                        self._startup_failures = 0
+                        self.stats["ready"] += 1
+                    if worker_id in self._workers:
+                        self._idle.append(worker_id)
+                self._assign_jobs()
+            elif kind == "failed":
+                with self._lock:
+                    process = self._forget_worker(worker_id)
+                if process is not None:
+                    process.join()
+                self._startup_failed(worker_id, payload)
+            elif kind == "progress":
+                self._notify(job_id, {"event": "progress", "line": payload})
+            elif kind == "done":
+                with self._lock:
+                    self._running_job.pop(worker_id, None)
+                self._notify(job_id, {"event": "done", **payload})
+            elif kind == "error":
+                with self._lock:
+                    self._running_job.pop(worker_id, None)
+                self._notify(job_id, {"event": "error", "message": payload})
+            elif kind == "retire":
+                print(f"Recycling worker {worker_id} after {payload['jobs']} job(s), {payload['rss_mb']} MiB RSS")
+                with self._lock:
+                    process = self._forget_worker(worker_id)
+                if process is None:
+                    continue
+                process.join()
+                with self._lock:
+                    self.stats["recycled"] += 1
+                self._spawn_worker()
+
+    def _startup_failed(self, worker_id: int, reason: str):
+        """Respawns a worker that died before becoming ready, backing off each time."""
+        with self._lock:
+            self._starting.discard(worker_id)
+            self._startup_failures += 1
+            self.stats["startup_failures"] += 1
+            failures = self._startup_failures
+            if failures >= MAX_STARTUP_FAILURES:
+                self.broken = f"{failures} workers in a row failed to start, last: {reason}"
+                pending = list(self._listeners.values())
+                self._pending.clear()
+        print(f"Worker {worker_id} failed to start ({reason})")
+
+        if self.broken:
+            print(f"Error: {self.broken}; no more workers will be started")
+            for listener in pending:
+                listener.put({"event": "error", "message": f"Worker pool unavailable: {self.broken}"})
+            return
+        delay = min(MAX_STARTUP_BACKOFF_S, STARTUP_BACKOFF_S * 2 ** (failures - 1))
+        print(f"Retrying in {delay:g}s")
+        timer = threading.Timer(delay, self._spawn_worker)
+        timer.daemon = True
+        timer.start()
+
+    def _reap_dead_workers(self):
+        with self._lock:
+            dead = [(wid, p) for wid, p in self._workers.items() if not p.is_alive()]
+            if self._closed:
+                return
+            for worker_id, _ in dead:
+                self._forget_worker(worker_id)
+        for worker_id, process in dead:
+            with self._lock:
+                starting = worker_id in self._starting
+                job_id = self._running_job.pop(worker_id, None)
+            if starting:
+                self._startup_failed(worker_id, f"exit code {process.exitcode}")
+                continue
+            if job_id is not None:
+                self._notify(job_id, {"event": "error", "message": f"worker exited with code {process.exitcode}"})
+            print(f"Worker {worker_id} died (exit code {process.exitcode}), replacing it")
+            self._spawn_worker()
+
+    def submit(self, fname: str):
+        """Queues a particle file and yields its progress/done/error events."""
+        job_id = next(self._job_ids)
+        listener: queue.Queue = queue.Queue()
+        with self._lock:
+            if self.broken:
+                yield {"event": "error", "message": f"Worker pool unavailable: {self.broken}"}
+                return
+            self._listeners[job_id] = listener
+            self._pending.append((job_id, fname))
+            self.stats["jobs"] += 1
+        self._assign_jobs()
+        try:
+            while True:
+                event = listener.get()
+                yield event
+                if event["event"] in ("done", "error"):
+                    break
+        finally:
+            with self._lock:
+                self._listeners.pop(job_id, None)
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": len(self._workers),
+                "busy": len(self._running_job),
+                "queued": len(self._pending),
+                "broken": self.broken,
+                **self.stats,
+            }
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            workers = list(self._workers.values())
+            for jobs in self._worker_jobs.values():
+                jobs.put(None)
+        for process in workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def _send(self, message: Dict[str, Any]):
+        self.wfile.write((json.dumps(message) + "\n").encode())
+        self.wfile.flush()
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            self._send({"event": "error", "message": f"Invalid request: {e}"})
+            return
+
+        op = request.get("op")
+        if op == "ping":
+            self._send({"event": "pong", "healthy": self.server.pool.broken is None})
+        elif op == "status":
+            self._send({"event": "status", **self.server.pool.status()})
+        elif op == "compute":
+            for event in self.server.pool.submit(request["particle"]):
+                self._send(event)
+        elif op == "shutdown":
+            self._send({"event": "bye"})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+        else:
+            self._send({"event": "error", "message": f"Unknown op: {op}"})
+
+
+class MieServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, pool: WorkerPool):
+        self.pool = pool
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, _RequestHandler)
+        os.chmod(socket_path, 0o600)
+
+
+def serve(
+    socket_path: str = SOCKET_PATH,
+    processes: int = 1,
+    threads: int = 1,
+    max_jobs: int = DEFAULT_MAX_JOBS_PER_WORKER,
+    max_rss_mb: float = DEFAULT_MAX_RSS_MB,
+    warmup_particle: Optional[str] = None,
+):
+    pool = WorkerPool(processes, threads, max_jobs, max_rss_mb, warmup_particle)
+    server = MieServer(socket_path, pool)
+    print(f"GEOSmie daemon listening on {socket_path} with {processes} worker(s) x {threads} thread(s)")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        print("GEOSmie daemon stopped")
+
+
+# --- Client API ---
+
+def _request(message: Dict[str, Any], socket_path: str = SOCKET_PATH, timeout: Optional[float] = None):
+    """Sends one request and yields each JSON event the daemon streams back."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(message) + "\n").encode())
+        with sock.makefile("r") as reader:
+            for line in reader:
+                yield json.loads(line)
+
+
+def is_running(socket_path: str = SOCKET_PATH, require_healthy: bool = True) -> bool:
+    """True when a daemon is listening and, unless disabled, its worker pool is usable."""
+    try:
+        reply = next(_request({"op": "ping"}, socket_path, timeout=1.0))
+        return reply["event"] == "pong" and (reply.get("healthy", True) or not require_healthy)
+    except (OSError, StopIteration, ValueError):
+        return False
+
+
+def status(socket_path: str = SOCKET_PATH) -> Dict[str, Any]:
+    return next(_request({"op": "status"}, socket_path, timeout=5.0))
+
+
+def shutdown(socket_path: str = SOCKET_PATH):
+    for _ in _request({"op": "shutdown"}, socket_path, timeout=5.0):
+        pass
+
+
+def submit(
+    fname: str,
+    on_progress: Optional[Callable[[str], None]] = None,
+    socket_path: str = SOCKET_PATH,
+    timeout: Optional[float] = None,
+) -> Dict[str, Any]:
+    """Runs optics and bands for a particle file on a warm worker.
+
+    With a timeout, gives up (socket.timeout) once the daemon has sent
+    nothing for that many seconds.
+    """
+    if on_progress is None:
+        on_progress = lambda line: print(f"\t{line}")
+    for event in _request({"op": "compute", "particle": str(fname)}, socket_path, timeout=timeout):
+        if event["event"] == "progress":
+            on_progress(event["line"])
+        elif event["event"] == "done":
+            return event
+        elif event["event"] == "error":
+            raise RuntimeError(event["message"])
+    raise RuntimeError("Daemon closed the connection before the job finished")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warm GEOSmie worker daemon")
+    parser.add_argument("--socket", default=SOCKET_PATH)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--max-jobs", type=int, default=DEFAULT_MAX_JOBS_PER_WORKER,
+                        help="Recycle a worker after this many jobs")
+    parser.add_argument("--max-rss-mb", type=float, default=DEFAULT_MAX_RSS_MB,
+                        help="Recycle a worker once its resident memory exceeds this")
+    parser.add_argument("--warmup-particle", default=None,
+                        help="Particle file (relative to GEOSmie) run once per worker to compile numba kernels")
+    args = parser.parse_args()
+    serve(args.socket, args.processes, args.threads, args.max_jobs, args.max_rss_mb, args.warmup_particle)
@@ -0,0 +1,223 @@
+import argparse
+import itertools
+import json
+import math
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from backend import plan_workers
+
+
+DEFAULT_ATOL = 0.0
+DEFAULT_RTOL = 1e-5
+# Most elements read per variable per task, bounding each worker's memory
+CHUNK_ELEMENTS = 4_000_000
+# Axes the report breaks errors down by, in the names GEOSmie/runbands use
+GROUP_DIMS = {
+    "bin": ("radius", "bin", "nbin"),
+    "rh": ("rh",),
+    "wavelength": ("lambda", "wavelength", "wavelengths", "band", "bands"),
+}
+EXIT_PASS, EXIT_FAIL, EXIT_MISMATCH = 0, 1, 2
+
+
+def _group_axes(dims: Tuple[str, ...]) -> Dict[str, int]:
+    axes = {}
+    for group, names in GROUP_DIMS.items():
+        for axis, dim in enumerate(dims):
+            if dim in names:
+                axes[group] = axis
+                break
+    return axes
+
+
+def _compare_chunk(task: Tuple[str, str, str, Tuple[Tuple[int, int], ...], float, float]) -> Dict[str, Any]:
+    """Compares one block of a variable, given as (start, stop) on its leading axes; runs in a worker process."""
+    import netCDF4
+    import numpy as np
+
+    ref_fname, test_fname, name, bounds, atol, rtol = task
+    with netCDF4.Dataset(ref_fname) as ref_ds, netCDF4.Dataset(test_fname) as test_ds:
+        ref_var = ref_ds.variables[name]
+        dims = ref_var.dimensions
+        index = tuple(slice(start, stop) for start, stop in bounds) if dims else Ellipsis
+        ref = np.ma.filled(ref_var[index], np.nan).astype(np.float64)
+        test = np.ma.filled(test_ds.variables[name][index], np.nan).astype(np.float64)
+
+    abs_err = np.abs(test - ref)
+    rel_err = abs_err / np.maximum(np.abs(ref), np.finfo(np.float64).tiny)
+    # Matching NaNs (e.g. fill values) agree; a NaN on one side only is an error
+    both_nan = np.isnan(ref) & np.isnan(test)
+    abs_err = np.where(both_nan, 0.0, np.where(np.isnan(abs_err), np.inf, abs_err))
+    rel_err = np.where(both_nan, 0.0, np.where(np.isnan(rel_err), np.inf, rel_err))
+    violations = abs_err > atol + rtol * np.abs(np.nan_to_num(ref))
+
+    result = {
+        "name": name,
+        "max_abs": float(abs_err.max(initial=0.0)),
+        "max_rel": float(rel_err.max(initial=0.0)),
+        "violations": int(violations.sum()),
+        "size": int(abs_err.size),
+        "groups": {},
+    }
+    for group, axis in _group_axes(dims).items():
+        other_axes = tuple(a for a in range(abs_err.ndim) if a != axis)
+        result["groups"][group] = {
+            "max_abs": abs_err.max(axis=other_axes, initial=0.0).tolist(),
+            "max_rel": rel_err.max(axis=other_axes, initial=0.0).tolist(),
+            "offset": bounds[axis][0] if axis < len(bounds) else 0,
+        }
+    return result
+
+
+def _chunk_bounds(shape: Tuple[int, ...]) -> List[Tuple[Tuple[int, int], ...]]:
+    """Splits a shape into blocks of at most CHUNK_ELEMENTS along as few leading axes as possible.
+
+    All but the last split axis are taken one index at a time; the last one
+    in runs sized to fill a block.
+    """
+    if not shape:
+        return [()]
+    split = 1
+    while split < len(shape) and math.prod(shape[split:]) > CHUNK_ELEMENTS:
+        split += 1
+    inner = max(1, math.prod(shape[split:]))
+    step = max(1, CHUNK_ELEMENTS // inner)
+    outer = itertools.product(*(range(n) for n in shape[:split - 1]))
+    return [
+        tuple((i, i + 1) for i in prefix) + ((start, min(shape[split - 1], start + step)),)
+        for prefix in outer
+        for start in range(0, shape[split - 1], step)
+    ]
+
+
+def _plan_tasks(
+    ref_fname: str,
+    test_fname: str,
+    variables: Optional[List[str]],
+    tolerances: Dict[str, Tuple[float, float]],
+    default_tolerance: Tuple[float, float],
+):
+    """Splits every comparable variable into row chunks; returns (tasks, structural problems)."""
+    import netCDF4
+    import numpy as np
+
+    tasks, problems = [], []
+    with netCDF4.Dataset(ref_fname) as ref_ds, netCDF4.Dataset(test_fname) as test_ds:
+        names = variables or list(ref_ds.variables)
+        for name in names:
+            if name not in ref_ds.variables or name not in test_ds.variables:
+                problems.append(f"{name}: missing from {'reference' if name not in ref_ds.variables else 'test'} file")
+                continue
+            ref_var, test_var = ref_ds.variables[name], test_ds.variables[name]
+            if not np.issubdtype(ref_var.dtype, np.number):
+                continue
+            if ref_var.shape != test_var.shape:
+                problems.append(f"{name}: shape {ref_var.shape} vs {test_var.shape}")
+                continue
+            atol, rtol = tolerances.get(name, default_tolerance)
+            for bounds in _chunk_bounds(ref_var.shape):
+                tasks.append((ref_fname, test_fname, name, bounds, atol, rtol))
+        if variables is None:
+            problems += [f"{name}: missing from reference file" for name in test_ds.variables if name not in ref_ds.variables]
+    return tasks, problems
+
+
+def _merge_groups(into: Dict[str, Any], chunk: Dict[str, Any]):
+    for group, errors in chunk["groups"].items():
+        merged = into.setdefault(group, {"max_abs": [], "max_rel": []})
+        for key in ("max_abs", "max_rel"):
+            values = errors[key]
+            offset = errors["offset"]
+            current = merged[key]
+            if len(current) < offset + len(values):
+                current.extend([0.0] * (offset + len(values) - len(current)))
+            for i, value in enumerate(values):
+                current[offset + i] = max(current[offset + i], value)
+
+
+def compare_files(
+    ref_fname: str,
+    test_fname: str,
+    variables: Optional[List[str]] = None,
+    atol: float = DEFAULT_ATOL,
+    rtol: float = DEFAULT_RTOL,
+    tolerances: Optional[Dict[str, Tuple[float, float]]] = None,
+    workers: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Compares two optics/bands files chunk by chunk across worker processes.
+
+    Each variable passes when |test - ref| <= atol + rtol * |ref| everywhere,
+    with per-variable (atol, rtol) overrides taken from tolerances.
+    """
+    tolerances = tolerances or {}
+    tasks, problems = _plan_tasks(str(ref_fname), str(test_fname), variables, tolerances, (atol, rtol))
+
+    if workers is None:
+        workers = plan_workers(max(1, len(tasks)))["processes"]
+    report: Dict[str, Any] = {"reference": str(ref_fname), "test": str(test_fname), "problems": problems, "variables": {}}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk in executor.map(_compare_chunk, tasks):
+            entry = report["variables"].setdefault(chunk["name"], {
+                "max_abs": 0.0, "max_rel": 0.0, "violations": 0, "size": 0, "groups": {},
+                "tolerance": tolerances.get(chunk["name"], (atol, rtol)),
+            })
+            entry["max_abs"] = max(entry["max_abs"], chunk["max_abs"])
+            entry["max_rel"] = max(entry["max_rel"], chunk["max_rel"])
+            entry["violations"] += chunk["violations"]
+            entry["size"] += chunk["size"]
+            _merge_groups(entry["groups"], chunk)
+
+    for entry in report["variables"].values():
+        entry["passed"] = entry["violations"] == 0
+    report["passed"] = not problems and all(entry["passed"] for entry in report["variables"].values())
+    report["exit_code"] = EXIT_MISMATCH if problems else (EXIT_PASS if report["passed"] else EXIT_FAIL)
+    return report
+
+
+def print_report(report: Dict[str, Any], all_groups: bool = False):
+    print(f"--- Comparing {report['test']} against {report['reference']} ---")
+    for problem in report["problems"]:
+        print(f"\tSTRUCTURE: {problem}")
+    print(f"\t{'variable':<12} {'max abs':>12} {'max rel':>12} {'violations':>12}  status")
+    for name, entry in report["variables"].items():
+        status = "ok" if entry["passed"] else "FAIL"
+        print(f"\t{name:<12} {entry['max_abs']:>12.4g} {entry['max_rel']:>12.4g} {entry['violations']:>12}  {status}")
+        if all_groups or not entry["passed"]:
+            for group, errors in entry["groups"].items():
+                rel = ", ".join(f"{value:.3g}" for value in errors["max_rel"])
+                print(f"\t    max rel per {group}: [{rel}]")
+    print(f"--- {'PASS' if report['passed'] else 'FAIL'} (exit code {report['exit_code']}) ---")
+
+
+def parse_tolerance(value: str) -> Tuple[str, Tuple[float, float]]:
+    """Parses 'name=atol,rtol' from the command line."""
+    name, _, tols = value.partition("=")
+    atol, _, rtol = tols.partition(",")
+    if not name or not atol or not rtol:
+        raise argparse.ArgumentTypeError(f"Expected name=atol,rtol, got {value}")
+    return name, (float(atol), float(rtol))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Numeric diff of GEOSmie optics/bands files")
+    parser.add_argument("reference")
+    parser.add_argument("test")
+    parser.add_argument("--atol", type=float, default=DEFAULT_ATOL)
+    parser.add_argument("--rtol", type=float, default=DEFAULT_RTOL)
+    parser.add_argument("--tol", type=parse_tolerance, action="append", default=[],
+                        help="Per-variable tolerance as name=atol,rtol (repeatable)")
+    parser.add_argument("--variables", nargs="+", default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--groups", action="store_true",
+                        help="Show per-bin/RH/wavelength errors for passing variables too")
+    parser.add_argument("--json", default=None, help="Also write the full report to this file")
+    args = parser.parse_args()
+
+    report = compare_files(args.reference, args.test, args.variables, args.atol, args.rtol, dict(args.tol), args.workers)
+    print_report(report, args.groups)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(report["exit_code"])
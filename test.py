@@ -1,10 +1,13 @@
 import cProfile
+import json
 import pstats
 import tracemalloc
 import runpy
 import os
 import sys
 import pathlib
+import shutil
+import time
 
 def geos_runner():
     runner_script_dir = pathlib.Path(__file__).parent.resolve()
@@ -44,7 +47,129 @@ def geos_runner():
         sys.argv = original_argv
 
 
+def daemon_turnaround_report(particle: str = "geosparticles/bc.json", runs: int = 5, target_s: float = 1.0) -> int:
+    """Times a cold optics+bands run against the same particle on a warm daemon worker."""
+    import statistics
+    import mie_daemon
+    from backend import plan_workers, runbands, runoptics, start_daemon, stop_daemon, thread_limited_env
+
+    # Cold and warm paths get the same single-process thread budget
+    env = thread_limited_env(plan_workers(1)["threads_per_process"])
+    start = time.perf_counter()
+    optic_fname = runoptics(particle, env=env)
+    if optic_fname:
+        runbands(optic_fname, env=env)
+    cold_time = time.perf_counter() - start
+    if not optic_fname:
+        print("Error: cold run failed")
+        return 1
+
+    started_here = not mie_daemon.is_running(require_healthy=False)
+    if started_here:
+        start_daemon(processes=1, warmup_particle=particle)
+    try:
+        deadline = time.monotonic() + 300
+        while mie_daemon.status()["ready"] < 1:
+            if mie_daemon.status()["broken"] or time.monotonic() > deadline:
+                print(f"Error: daemon worker never became ready: {mie_daemon.status()}")
+                return 1
+            time.sleep(0.2)
+
+        warm_times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            mie_daemon.submit(particle, on_progress=lambda line: None)
+            warm_times.append(time.perf_counter() - start)
+    finally:
+        if started_here:
+            stop_daemon()
+
+    warm_median = statistics.median(warm_times)
+    print('-'*40)
+    print(f"cold run (new interpreter): {cold_time:.2f}s")
+    print(f"warm daemon runs: {', '.join(f'{t:.2f}' for t in warm_times)}s (median {warm_median:.2f}s)")
+    print(f"speedup: {cold_time / warm_median:.1f}x, target {target_s:g}s: {'ok' if warm_median < target_s else 'MISSED'}")
+    return 0 if warm_median < target_s else 1
+
+
+def accuracy_speed_report(particle: str = "geosparticles/bc.json", rtol: float = 1e-5) -> int:
+    """Times each accelerated optics mode against a plain run and diffs the outputs.
+
+    Binned runs must reproduce the reference to rtol; mixing is held to
+    fracs_mixing's own VERIFY_RTOL.
+    """
+    from backend import GEOSMIE_DIR, plan_workers, runoptics, thread_limited_env
+    from bin_parallel import runoptics_binned
+    from fracs_mixing import MIXABLE_PSD_TYPES, VERIFY_RTOL, mix_particle
+    from optics_diff import compare_files, print_report
+
+    # Same per-process thread limit the accelerated modes run their jobs under
+    ref_env = thread_limited_env(plan_workers(1)["threads_per_process"])
+    start = time.perf_counter()
+    try:
+        ref_output = runoptics(particle, env=ref_env)
+    except Exception as e:
+        print(f"Error occurred in reference run: {e}")
+        ref_output = None
+    ref_time = time.perf_counter() - start
+    if not ref_output:
+        print("Error: reference run failed")
+        return 1
+
+    modes = [("bins", lambda: runoptics_binned(particle), rtol)]
+    with open(GEOSMIE_DIR / particle) as f:
+        if json.load(f)["psd"]["type"] in MIXABLE_PSD_TYPES:
+            mixing_rtol = max(rtol, VERIFY_RTOL)
+            modes += [
+                ("mixing (build)", lambda: mix_particle(particle, require_verified=False), mixing_rtol),
+                ("mixing (reuse)", lambda: mix_particle(particle, require_verified=False), mixing_rtol),
+            ]
+
+    # Binned runs write the usual output name, so keep the reference aside
+    # and put it back afterwards
+    ref_path = GEOSMIE_DIR / ref_output
+    ref_fname = str(GEOSMIE_DIR / f"{ref_output}.reference")
+    shutil.move(str(ref_path), ref_fname)
+    rows = [("reference", ref_time, None, rtol)]
+    try:
+        for name, run, mode_rtol in modes:
+            start = time.perf_counter()
+            try:
+                output = run()
+                elapsed = time.perf_counter() - start
+                report = compare_files(ref_fname, str(GEOSMIE_DIR / output), rtol=mode_rtol) if output else None
+            except Exception as e:
+                print(f"Error occurred in mode {name}: {e}")
+                elapsed = time.perf_counter() - start
+                report = None
+            if report:
+                print_report(report)
+            rows.append((name, elapsed, report, mode_rtol))
+    finally:
+        shutil.move(ref_fname, str(ref_path))
+
+    print('-'*40)
+    print(f"{'mode':<16} {'time (s)':>10} {'speedup':>8} {'max rel':>10} {'rtol':>8}  status")
+    exit_code = 0
+    for name, elapsed, report, mode_rtol in rows:
+        if report is None and name != "reference":
+            print(f"{name:<16} {elapsed:>10.2f} {'':>8} {'':>10} {mode_rtol:>8.0e}  FAILED TO RUN")
+            exit_code = max(exit_code, 1)
+            continue
+        max_rel = max((v["max_rel"] for v in report["variables"].values()), default=0.0) if report else 0.0
+        status = "reference" if report is None else ("ok" if report["passed"] else "FAIL")
+        print(f"{name:<16} {elapsed:>10.2f} {ref_time / elapsed:>7.1f}x {max_rel:>10.3g} {mode_rtol:>8.0e}  {status}")
+        if report:
+            exit_code = max(exit_code, report["exit_code"])
+    return exit_code
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--accuracy":
+        sys.exit(accuracy_speed_report(*sys.argv[2:3]))
+    if len(sys.argv) > 1 and sys.argv[1] == "--daemon":
+        sys.exit(daemon_turnaround_report(*sys.argv[2:3]))
+
     profiler = cProfile.Profile()
     profiler.enable()
     tracemalloc.start()
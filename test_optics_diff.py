@@ -0,0 +1,74 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+netCDF4 = pytest.importorskip("netCDF4")
+
+import optics_diff
+
+
+def _write_optics(path, bext):
+    with netCDF4.Dataset(str(path), "w") as ds:
+        ds.createDimension("lambda", bext.shape[0])
+        ds.createDimension("rh", bext.shape[1])
+        ds.createDimension("radius", bext.shape[2])
+        ds.createVariable("lambda", "f8", ("lambda",))[:] = np.linspace(0.4e-6, 0.8e-6, bext.shape[0])
+        ds.createVariable("rh", "f8", ("rh",))[:] = np.linspace(0.0, 0.9, bext.shape[1])
+        ds.createVariable("bext", "f8", ("lambda", "rh", "radius"))[:] = bext
+
+
+@pytest.fixture
+def optics_pair(tmp_path):
+    ref = np.arange(1.0, 1.0 + 3 * 4 * 5).reshape(3, 4, 5)
+    test = ref.copy()
+    test[1, 2, 3] *= 1.01
+    _write_optics(tmp_path / "ref.nc4", ref)
+    _write_optics(tmp_path / "test.nc4", test)
+    return tmp_path / "ref.nc4", tmp_path / "test.nc4"
+
+
+@pytest.mark.parametrize("chunk_elements", [optics_diff.CHUNK_ELEMENTS, 1, 7])
+def test_single_element_difference(optics_pair, monkeypatch, chunk_elements):
+    monkeypatch.setattr(optics_diff, "CHUNK_ELEMENTS", chunk_elements)
+    report = optics_diff.compare_files(*optics_pair, workers=1)
+
+    assert report["exit_code"] == optics_diff.EXIT_FAIL
+    assert not report["problems"]
+    assert report["variables"]["lambda"]["passed"] and report["variables"]["rh"]["passed"]
+    bext = report["variables"]["bext"]
+    assert bext["violations"] == 1
+    assert bext["size"] == 60
+    assert bext["max_rel"] == pytest.approx(0.01)
+    for group, position, length in (("wavelength", 1, 3), ("rh", 2, 4), ("bin", 3, 5)):
+        max_rel = bext["groups"][group]["max_rel"]
+        assert len(max_rel) == length
+        assert max_rel[position] == pytest.approx(0.01)
+        assert all(value == 0.0 for i, value in enumerate(max_rel) if i != position)
+
+
+def test_identical_files_pass(optics_pair):
+    report = optics_diff.compare_files(optics_pair[0], optics_pair[0], workers=1)
+    assert report["passed"] and report["exit_code"] == optics_diff.EXIT_PASS
+
+
+def test_tolerance_override(optics_pair):
+    report = optics_diff.compare_files(*optics_pair, tolerances={"bext": (0.0, 0.02)}, workers=1)
+    assert report["exit_code"] == optics_diff.EXIT_PASS
+
+
+def test_shape_mismatch(tmp_path):
+    _write_optics(tmp_path / "ref.nc4", np.ones((3, 4, 5)))
+    _write_optics(tmp_path / "test.nc4", np.ones((3, 4, 6)))
+    report = optics_diff.compare_files(tmp_path / "ref.nc4", tmp_path / "test.nc4", workers=1)
+    assert report["exit_code"] == optics_diff.EXIT_MISMATCH
+
+
+def test_chunks_stay_within_limit(monkeypatch):
+    monkeypatch.setattr(optics_diff, "CHUNK_ELEMENTS", 10)
+    shape = (2, 3, 40)
+    bounds = optics_diff._chunk_bounds(shape)
+    covered = np.zeros(shape, dtype=int)
+    for block in bounds:
+        index = tuple(slice(start, stop) for start, stop in block)
+        assert covered[index].size <= 10
+        covered[index] += 1
+    assert (covered == 1).all()